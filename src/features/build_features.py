@@ -1,21 +1,359 @@
 import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
+from hashlib import sha1
+from inspect import signature
+import json
+import os
+from pathlib import Path
+from tempfile import mkstemp
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 import re
 from itertools import chain
 
+# part of every Parquet cache file name; bump it when a cached loader's output
+# changes in a way the *_TYPES schemas below don't capture
+CACHE_VERSION = 1
 
-def import_csvs(pbp_cols, year=2018, weeks=16, encoding="ISO-8859-1"):
-    for week in range(1, weeks + 1):
-        df = pd.DataFrame(
-            pd.read_csv(f"../data/raw/pbp/{year} Week {week}.csv", encoding=encoding),
-            columns=pbp_cols,
+# Arrow types applied while parsing, so no columns need to be cast after loading
+PBP_TYPES = {
+    "id": pa.int64(),
+    "week": pa.int8(),
+    "offense": pa.string(),
+    "offense_conference": pa.string(),
+    "defense": pa.string(),
+    "defense_conference": pa.string(),
+    "offense_score": pa.int16(),
+    "defense_score": pa.int16(),
+    "drive_id": pa.int64(),
+    "period": pa.int8(),
+    "clock.minutes": pa.int8(),
+    "clock.seconds": pa.int8(),
+    "yard_line": pa.int16(),
+    "down": pa.int8(),
+    "distance": pa.int16(),
+    "yards_gained": pa.int16(),
+    "play_type": pa.string(),
+    "play_text": pa.string(),
+}
+DRIVE_TYPES = {
+    "offense": pa.string(),
+    "offense_conference": pa.string(),
+    "defense": pa.string(),
+    "defense_conference": pa.string(),
+    "game_id": pa.int64(),
+    "id": pa.int64(),
+    "scoring": pa.bool_(),
+    "start_period": pa.int8(),
+    "start_yardline": pa.int16(),
+    "start_time.minutes": pa.int8(),
+    "end_period": pa.int8(),
+    "end_yardline": pa.int16(),
+    "end_time.minutes": pa.int8(),
+    "end_time.seconds": pa.int8(),
+    "elapsed.minutes": pa.int8(),
+    "elapsed.seconds": pa.int8(),
+    "plays": pa.int16(),
+    "yards": pa.int16(),
+    "drive_result": pa.string(),
+    "week": pa.int8(),
+}
+MATCHUP_TYPES = {
+    "id": pa.int64(),
+    "season": pa.int16(),
+    "week": pa.int8(),
+    "season_type": pa.string(),
+    "start_date": pa.string(),
+    "neutral_site": pa.bool_(),
+    "conference_game": pa.bool_(),
+    "attendance": pa.int32(),
+    "venue_id": pa.int32(),
+    "venue": pa.string(),
+    "home_team": pa.string(),
+    "home_conference": pa.string(),
+    "home_points": pa.int16(),
+    **{f"home_line_scores[{i}]": pa.int16() for i in range(4)},
+    "away_team": pa.string(),
+    "away_conference": pa.string(),
+    "away_points": pa.int16(),
+    **{f"away_line_scores[{i}]": pa.int16() for i in range(4)},
+    # only weeks with an overtime game have a fifth period
+    "home_line_scores[4]": pa.int16(),
+    "away_line_scores[4]": pa.int16(),
+}
+# the matchup columns that get_pbp merges onto each play
+LOCATION_COLS = ("id", "home_team", "away_team", "neutral_site", "conference_game")
+
+
+def read_weeks(kind, columns, column_types, year, weeks, path, encoding):
+    """Return a list of Arrow tables, one per week, for a type of raw data.
+
+    Columns missing from a week's file are included as all-null columns so
+    every table has the same schema. A 'week' column, if requested but not in
+    the file, is filled with the week number. Weeks are read in parallel
+    threads and returned in week order.
+
+    Arguments:
+    kind -- a str of either 'pbp', 'drives' or 'matchups'
+    columns -- list of columns to keep, in order
+    column_types -- dict mapping column names to Arrow types
+    """
+
+    def read_week(week):
+        tbl = pacsv.read_csv(
+            f"{path}/raw/{kind}/{year} Week {week}.csv",
+            read_options=pacsv.ReadOptions(encoding=encoding),
+            convert_options=pacsv.ConvertOptions(
+                include_columns=columns,
+                include_missing_columns=True,
+                column_types=column_types,
+                strings_can_be_null=True,
+            ),
         )
-        df.fillna({"clock.minutes": 0, "clock.seconds": 0}, inplace=True)
-        df["week"] = week
-        df = df.sort_values(["id"])
-        df["id"] = df["id"].floordiv(1000000000)
-        data = data.append(df, ignore_index=True)
-        # finish establishing the data object and returning it from the function
+        if "week" in columns and tbl["week"].null_count == tbl.num_rows:
+            tbl = tbl.set_column(
+                tbl.schema.get_field_index("week"),
+                "week",
+                pa.array(np.full(tbl.num_rows, week), type=column_types["week"]),
+            )
+        return tbl
+
+    with ThreadPoolExecutor(max_workers=min(8, weeks)) as executor:
+        return list(executor.map(read_week, range(1, weeks + 1)))
+
+
+def tables_to_frame(tables):
+    """Concatenate Arrow tables and convert them to an Arrow-backed DataFrame."""
+    return pa.concat_tables(tables, promote_options="default").to_pandas(
+        split_blocks=True, self_destruct=True, types_mapper=pd.ArrowDtype
+    )
+
+
+def write_cache(data, cache):
+    """Write a DataFrame to a Parquet file that read_cache can restore exactly.
+
+    Parquet keeps the Arrow types but not whether pandas held a column (or a
+    categorical's categories) as an ArrowDtype, so the names of those columns
+    are stored in the file's metadata. The file is written under a temporary
+    name and then moved into place, so an interrupted write never leaves a
+    truncated cache behind.
+    """
+    arrow_cols = [
+        col
+        for col, dtype in data.dtypes.items()
+        if isinstance(dtype, pd.ArrowDtype)
+        or (
+            isinstance(dtype, pd.CategoricalDtype)
+            and isinstance(dtype.categories.dtype, pd.ArrowDtype)
+        )
+    ]
+    table = pa.Table.from_pandas(data)
+    table = table.replace_schema_metadata(
+        {**table.schema.metadata, b"arrow_columns": json.dumps(arrow_cols).encode()}
+    )
+    fd, tmp = mkstemp(suffix=".tmp", dir=Path(cache).parent)
+    os.close(fd)
+    try:
+        pq.write_table(table, tmp, compression="zstd")
+        os.replace(tmp, cache)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def read_cache(cache):
+    """Read a Parquet file written by write_cache with its original dtypes.
+
+    Categorical columns that Parquet stores as plain values (e.g. integer game
+    ids) are cast back to categories, and Arrow-backed columns and categories
+    are restored as ArrowDtypes instead of pandas' default string dtype.
+    """
+    table = pq.read_table(cache)
+    schema = table.schema
+    arrow_cols = set(json.loads(schema.metadata.get(b"arrow_columns", b"[]")))
+    categorical = {
+        col["name"]
+        for col in schema.pandas_metadata["columns"]
+        if col["pandas_type"] == "categorical"
+    }
+    data = table.to_pandas(split_blocks=True, self_destruct=True)
+    for col in data.columns:
+        arrow_type = schema.field(col).type
+        if pa.types.is_dictionary(arrow_type):
+            arrow_type = arrow_type.value_type
+        if col in categorical:
+            if data[col].dtype != "category":
+                data[col] = data[col].astype("category")
+            if col in arrow_cols:
+                values = data[col].cat
+                dtype = pd.CategoricalDtype(
+                    values.categories.astype(pd.ArrowDtype(arrow_type)),
+                    ordered=values.ordered,
+                )
+                data[col] = pd.Categorical.from_codes(values.codes, dtype=dtype)
+        elif col in arrow_cols and not isinstance(data[col].dtype, pd.ArrowDtype):
+            data[col] = data[col].astype(pd.ArrowDtype(arrow_type))
+    return data
+
+
+def share_categories(data, columns):
+    """Cast columns to one CategoricalDtype holding the values of all of them,
+    so comparing the columns compares integer codes instead of strings.
+
+    Arguments:
+    data -- the DataFrame to modify in place
+    columns -- list of columns that hold the same kind of value, e.g. teams
+    """
+    dtype = pd.CategoricalDtype(
+        sorted(set().union(*(data[col].dropna().unique() for col in columns)))
+    )
+    for col in columns:
+        data[col] = data[col].astype(dtype)
+    return data
+
+
+def cached_parquet(name, kinds, key_args=()):
+    """Cache the DataFrame returned by a loader as a Parquet file, so the raw
+    CSVs are only parsed the first time.
+
+    The decorated function must take 'year' and 'weeks' arguments; the cache
+    is written to {path}/interim/{name}_{year}_{weeks}_weeks_{hash}.parquet,
+    where path is the function's 'path' argument (default '../data') and hash
+    is a digest of CACHE_VERSION, the *_TYPES schemas and the arguments named
+    in key_args, so each selection of columns gets its own file and files
+    written by older code are not reused. The cache is rebuilt when any of
+    the raw CSVs it was built from is newer than it. The decorated function
+    must not have side effects, since they are skipped on a cache hit.
+
+    A cache hit returns the same dtypes as the call that wrote the cache; see
+    write_cache and read_cache.
+
+    Arguments:
+    name -- a str naming the dataset, e.g. 'pbp' or 'drives'
+    kinds -- the types of raw data the function reads, e.g. ('pbp', 'matchups')
+    key_args -- names of other arguments that change the returned DataFrame
+    """
+
+    def decorator(func):
+        params = signature(func)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = params.bind(*args, **kwargs)
+            bound.apply_defaults()
+            year, weeks = bound.arguments["year"], bound.arguments["weeks"]
+            path = bound.arguments.get("path", "../data")
+            key = repr(
+                [CACHE_VERSION, PBP_TYPES, DRIVE_TYPES, MATCHUP_TYPES]
+                + [list(bound.arguments[arg]) for arg in key_args]
+            )
+            digest = sha1(key.encode()).hexdigest()[:10]
+            cache = (
+                Path(path) / "interim" / f"{name}_{year}_{weeks}_weeks_{digest}.parquet"
+            )
+            sources = [
+                Path(path) / "raw" / kind / f"{year} Week {week}.csv"
+                for kind in kinds
+                for week in range(1, weeks + 1)
+            ]
+
+            if cache.exists() and cache.stat().st_mtime >= max(
+                source.stat().st_mtime for source in sources
+            ):
+                return read_cache(cache)
+
+            data = func(*args, **kwargs)
+            write_cache(data, cache)
+            return data
+
+        return wrapper
+
+    return decorator
+
+
+@lru_cache(maxsize=4)
+def _read_locations(year, weeks, path, columns):
+    locations = tables_to_frame(
+        read_weeks(
+            "matchups", list(columns), MATCHUP_TYPES, year, weeks, path, "ISO-8859-1"
+        )
+    )
+    return locations.sort_values(by="id").reset_index(drop=True)
+
+
+def load_locations(year, weeks, path="../data", columns=LOCATION_COLS):
+    """Return each game's teams and location from the matchup data, sorted by id.
+
+    The result is cached per (year, weeks, path, columns), so get_pbp and
+    score_verify.import_drives share one parse of the matchup files. The
+    arguments are normalised before the lookup, so keyword, positional and
+    list arguments all hit the same entry. Callers get the cached DataFrame
+    itself and must not modify it in place.
+
+    Arguments:
+    year -- the season to read
+    weeks -- the number of weeks to read
+    path -- the data directory containing raw/matchups
+    columns -- sequence of matchup columns to keep
+    """
+    return _read_locations(int(year), int(weeks), str(path), tuple(columns))
+
+
+load_locations.cache_info = _read_locations.cache_info
+load_locations.cache_clear = _read_locations.cache_clear
+
+
+def import_csvs(pbp_cols, year=2018, weeks=16, path="../data", encoding="ISO-8859-1"):
+    tables = read_weeks("pbp", pbp_cols, PBP_TYPES, year, weeks, path, encoding)
+    data = tables_to_frame([tbl.sort_by("id") for tbl in tables])
+    # not all weeks have seconds on the game clock, but all have minutes
+    data.fillna({"clock.minutes": 0, "clock.seconds": 0}, inplace=True)
+    data["id"] = data["id"] // 1000000000
+    data["play_type"] = data["play_type"].astype("category")
+    return data
+
+
+@cached_parquet("pbp", ("pbp", "matchups"), key_args=("pbp_cols", "matchup_cols"))
+def build_pbp(pbp_cols, matchup_cols, year, weeks, path):
+    """Return the play-by-play data merged with the matchup data.
+
+    The result is cached as Parquet; see get_pbp for the arguments.
+    """
+
+    # Import Play-by-Play and Matchup data #
+
+    # Load each week's PBP data
+    data = import_csvs(pbp_cols, year, weeks, path)
+
+    # Import each week's matchup data and combine into the locations DataFrame
+    locations = load_locations(year, weeks, path, matchup_cols)
+
+    # merge the PBP and matchup data with the 'id' column as the key
+    data = pd.merge(data, locations, on="id", how="left", sort=True)
+
+    # games are grouped on constantly, so store their ids as integer codes
+    data["id"] = data["id"].astype("category")
+
+    # give every team column the same categories, so comparing teams across
+    # columns compares integer codes instead of strings
+    share_categories(data, ["offense", "defense", "home_team", "away_team"])
+
+    # make columns that isolate the scores for each team
+    offense_score = data["offense_score"].to_numpy()
+    defense_score = data["defense_score"].to_numpy()
+    for place in "home", "away":
+        is_offense = (data["offense"] == data[f"{place}_team"]).to_numpy()
+        data[f"{place}_score"] = np.where(is_offense, offense_score, defense_score)
+
+    # flag kickoff plays once so later filters can use a boolean mask
+    data["is_kickoff"] = data["play_type"].str.contains(
+        "Kickoff", regex=False, na=False
+    )
+
+    return data
 
 
 def get_pbp(
@@ -40,65 +378,18 @@ def get_pbp(
         "play_text",
     ],
     matchup_cols=["id", "home_team", "away_team", "neutral_site", "conference_game"],
+    year=2018,
+    weeks=16,
+    path="../data",
     export_missing=True,
 ):
+    data = build_pbp(pbp_cols, matchup_cols, year, weeks, path)
 
-    # Import Play-by-Play and Matchup data #
-
-    # Initialize necessary DataFrames
-    data = pd.DataFrame(columns=pbp_cols)
-    locations = pd.DataFrame(columns=matchup_cols)
-
-    # Load each week's PBP data
-
-    # Import each week's matchup data and append to the locations DataFrame
-    for week in range(1, weeks + 1):
-        df = pd.DataFrame(
-            pd.read_csv(
-                f"{path}/raw/matchups/{year} Week {week}.csv", encoding="ISO-8859-1"
-            ),
-            columns=matchup_cols,
-        )
-        locations = locations.append(df, ignore_index=True)
-
-    # store the matchups without PBP data in a separate DataFrame, and drop them from the main DataFrame
-    pbp_missing = data[data["week"].isna()].copy()
-    data.drop(data[data["week"].isna()].index[:], inplace=True)
-
-    # change the dtypes of certain columns back to int or bool from float or object
-    data_types = {
-        "id": "int64",
-        "week": "int64",
-        "offense_score": "int64",
-        "defense_score": "int64",
-        "drive_id": "int64",
-        "period": "int64",
-        "clock.minutes": "int64",
-        "clock.seconds": "int64",
-        "yard_line": "int64",
-        "down": "int64",
-        "distance": "int64",
-        "yards_gained": "int64",
-        "neutral_site": "bool",
-        "conference_game": "bool",
-    }
-
-    # set dtypes for easier analysis
-    data = data.astype(data_types)
-    pbp_missing = pbp_missing.astype({"id": "int64"})
-
-    # make columns that isolate the scores for each team
-    for place in "home", "away":
-        offscore = data.loc[
-            (data["offense"] == data[f"{place}_team"]), "offense_score"
-        ].rename(f"{place}score")
-        defscore = data.loc[
-            (data["defense"] == data[f"{place}_team"]), "defense_score"
-        ].rename(f"{place}score")
-        data[f"{place}_score"] = pd.concat([offscore, defscore]).sort_index()
-
-    # export the missing games if desired
+    # export the matchups without PBP data if desired; this stays outside the
+    # cached build_pbp so it also runs on a cache hit
     if export_missing:
+        locations = load_locations(year, weeks, path, matchup_cols)
+        pbp_missing = locations.loc[~locations["id"].isin(data["id"].unique())]
         pbp_missing.to_csv(f"{path}/interim/errors/missing_games.csv")
 
     return data
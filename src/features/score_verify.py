@@ -1,6 +1,14 @@
 import pandas as pd
 import numpy as np
-from itertools import chain
+from src.features.build_features import (
+    DRIVE_TYPES,
+    MATCHUP_TYPES,
+    cached_parquet,
+    load_locations,
+    read_weeks,
+    share_categories,
+    tables_to_frame,
+)
 
 
 def get_drive_counts(side, pbp, drives):
@@ -15,69 +23,62 @@ def get_drive_counts(side, pbp, drives):
 
     The pbp dataset begins drives with the kicking team, resulting in one-play
     drives for the kicking team. This isn't how the drives dataset counts
-    drives, so we must exclude plays that contain the word 'kickoff' before
-    counting the number of drives.
+    drives, so plays that contain the word 'kickoff' must be excluded from pbp
+    before counting the number of drives.
 
     Arguments:
     side -- a str of either 'home' or 'away'
-    pbp -- name of the play-by-play DataFrame
+    pbp -- name of the play-by-play DataFrame, without kickoff plays
     drives -- name of the drives DataFrame
     """
     pbp_drives = (
-        pbp[~(pbp["play_type"].str.contains("Kickoff"))]
-        .loc[pbp["offense"] == pbp[f"{side}_team"]]
-        .groupby("id")
-        .agg({"drive_id": "nunique"})
+        pbp.loc[pbp["offense"] == pbp[f"{side}_team"]]
+        .groupby("id", sort=False, observed=True)["drive_id"]
+        .nunique()
+        .to_frame("pbp_drives")
     )
-    pbp_drives.rename({"drive_id": "pbp_drives"}, axis=1, inplace=True)
     drive_chart_drives = (
         drives.loc[drives["offense"] == drives[f"{side}_team"]]
-        .groupby("id")
-        .agg({"drive_id": "nunique"})
+        .groupby("id", sort=False, observed=True)["drive_id"]
+        .nunique()
+        .to_frame("drive_chart_drives")
     )
-    drive_chart_drives.rename({"drive_id": "drive_chart_drives"}, axis=1, inplace=True)
     df = pbp_drives.join(drive_chart_drives)
     df["difference"] = df["pbp_drives"] - df["drive_chart_drives"]
     df["side"] = side
     return df
 
 
-def import_drives(year, weeks):
-    drives = pd.DataFrame()
-    for week in range(1, weeks + 1):
-        df = pd.DataFrame(
-            pd.read_csv(
-                f"../data/raw/drives/{year} Week {week}.csv", encoding="ISO-8859-1"
-            )
-        )
-        df["week"] = week
-        drives = drives.append(df, ignore_index=True, sort=False)
+@cached_parquet("drives", ("drives", "matchups"))
+def import_drives(year, weeks, path="../data"):
+    tables = read_weeks(
+        "drives", list(DRIVE_TYPES), DRIVE_TYPES, year, weeks, path, "ISO-8859-1"
+    )
+    drives = tables_to_frame(tables)
     drives = drives.rename({"id": "drive_id", "game_id": "id"}, axis=1)
 
-    loc_columns = ["id", "home_team", "away_team", "neutral_site", "conference_game"]
-    locations = pd.DataFrame(columns=loc_columns)
-
-    for week in range(1, weeks + 1):
-        df = pd.DataFrame(
-            pd.read_csv(
-                f"../data/raw/matchups/{year} Week {week}.csv", encoding="ISO-8859-1"
-            ),
-            columns=loc_columns,
-        )
-        locations = locations.append(df, ignore_index=True)
-
-    locations = locations.sort_values(by="id").reset_index(drop=True)
+    locations = load_locations(year, weeks, path)
     drives = pd.merge(drives, locations, on="id", how="left")
+
+    # the drive counts compare offense to home_team and away_team per drive
+    share_categories(drives, ["offense", "defense", "home_team", "away_team"])
     return drives
 
 
 def get_pbp_drives(df, side):
+    """Return the unique drive ids of the offense in each game for a specified
+    side in the play-by-play dataset.
+
+    Kickoff plays must already be excluded from df, otherwise the kicking
+    team's one-play drives are listed as well.
+
+    Arguments:
+    df -- name of the play-by-play DataFrame, without kickoff plays
+    side -- a str of either 'home' or 'away'
+    """
     drives = (
-        df[
-            (df["offense"] == df[f"{side}_team"])
-            & (~(df["play_type"].str.contains("Kickoff")))
-        ]
-        .groupby("id")
+        df[df["offense"] == df[f"{side}_team"]]
+        .groupby("id", sort=False, observed=True)
         .agg({"drive_id": "unique"})
         .rename({"drive_id": "pbp_drive_id"}, axis=1)
     )
@@ -87,7 +88,7 @@ def get_pbp_drives(df, side):
 def get_dc_drives(df, side):
     drives = (
         df[df["offense"] == df[f"{side}_team"]]
-        .groupby("id")
+        .groupby("id", sort=False, observed=True)
         .agg({"drive_id": "unique"})
         .rename({"drive_id": f"dc_drive_id"}, axis=1)
     )
@@ -95,71 +96,98 @@ def get_dc_drives(df, side):
 
 
 def get_missing_drives(pbp, drives):
-    home_drive_counts = (
-        get_drive_counts("home", pbp, drives)
-        .join(get_pbp_drives(pbp, "home"))
-        .join(get_dc_drives(drives, "home"))
-    )
-    away_drive_counts = (
-        get_drive_counts("away", pbp, drives)
-        .join(get_pbp_drives(pbp, "away"))
-        .join(get_dc_drives(drives, "away"))
-    )
-    all_drive_counts = home_drive_counts.append(away_drive_counts)
-    all_drive_counts["extra_pbp_drives"] = all_drive_counts.apply(
-        lambda x: np.setdiff1d(x.pbp_drive_id, x.dc_drive_id), axis=1
+    # drop kickoffs once rather than in every helper; frames that were not
+    # built by get_pbp (e.g. the interim CSVs) have no is_kickoff column
+    if "is_kickoff" in pbp:
+        is_kickoff = pbp["is_kickoff"]
+    else:
+        is_kickoff = pbp["play_type"].str.contains("Kickoff", regex=False, na=False)
+    pbp = pbp.loc[~is_kickoff]
+    all_drive_counts = pd.concat(
+        [
+            get_drive_counts(side, pbp, drives)
+            .join(get_pbp_drives(pbp, side))
+            .join(get_dc_drives(drives, side))
+            for side in ("home", "away")
+        ]
     )
-    all_drive_counts["extra_pbp_drives"] = all_drive_counts["extra_pbp_drives"].apply(
-        lambda x: np.nan if len(x) == 0 else x
+
+    # find the drives only one dataset has with a single outer merge of the
+    # (game, side, drive) keys from both datasets
+    keys = ["id", "side", "drive_id"]
+    pbp_ids = pd.concat(
+        pbp.loc[pbp["offense"] == pbp[f"{side}_team"], ["id", "drive_id"]].assign(
+            side=side
+        )
+        for side in ("home", "away")
     )
-    all_drive_counts["extra_dc_drives"] = all_drive_counts.apply(
-        lambda x: np.setdiff1d(x.dc_drive_id, x.pbp_drive_id), axis=1
+    dc_ids = pd.concat(
+        drives.loc[
+            drives["offense"] == drives[f"{side}_team"], ["id", "drive_id"]
+        ].assign(side=side)
+        for side in ("home", "away")
     )
-    all_drive_counts["extra_dc_drives"] = all_drive_counts["extra_dc_drives"].apply(
-        lambda x: np.nan if len(x) == 0 else x
+    merged = (
+        pbp_ids[keys]
+        .drop_duplicates()
+        .merge(dc_ids[keys].drop_duplicates(), on=keys, how="outer", indicator=True)
+        .sort_values("drive_id")
     )
+    sources = {"extra_pbp_drives": "left_only", "extra_dc_drives": "right_only"}
+    for col, source in sources.items():
+        extra_drives = (
+            merged.loc[merged["_merge"] == source]
+            .groupby(["id", "side"], sort=False, observed=True)["drive_id"]
+            .agg(list)
+            .rename(col)
+        )
+        all_drive_counts = all_drive_counts.join(extra_drives, on=["id", "side"])
     return all_drive_counts
 
 
-def get_invalid_score_changes(pbp):
+def get_invalid_score_changes(pbp, num_plays=5):
     """Return a DataFrame of plays with invalid score changes, and the plays immediately
     before and after.
 
     Valid score changes are 2, 3, 6, 7, and 8 points. There are occasional
     one-point plays, but they are exceedingly rare. 
 
+    Each flagged play is returned in a group of num_plays plays: the play
+    before it, the play itself and the num_plays - 2 plays after it.
+
     Arguments:
     pbp -- name of the play-by-play DataFrame
+    num_plays -- the number of plays returned for each flagged play
     """
-    ends_of_games = [
-        pbp.loc[pbp["id"] == game].index[-1] for game in pbp["id"].unique()
-    ]
-    home_scores_to_check = pbp.loc[
-        ~(pbp.home_score.diff().isin([0, 2, 3, 6, 7, 8])) & (pbp.home_score != 0)
-    ]
-    away_scores_to_check = pbp.loc[
-        ~(pbp.away_score.diff().isin([0, 2, 3, 6, 7, 8])) & (pbp.away_score != 0)
-    ]
-    scores_to_check = home_scores_to_check.append(away_scores_to_check)
-    scores_to_check = scores_to_check.sort_index()
-    scores_index = [
-        item
-        for item in scores_to_check.index.tolist()
-        if item - 1 not in ends_of_games and item not in ends_of_games
-    ]
-    return pbp.loc[
-        list(
-            chain(
-                *zip(
-                    [item - 1 for item in scores_index],
-                    scores_index,
-                    [item + 1 for item in scores_index],
-                    [item + 2 for item in scores_index],
-                    [item + 3 for item in scores_index],
-                )
-            )
-        )
+    ends_of_games = (
+        pbp.groupby("id", sort=False, observed=True).tail(1).index.to_numpy()
+    )
+    score_cols = ["home_score", "away_score"]
+    scores = pbp[score_cols].to_numpy(dtype=np.float64, na_value=np.nan)
+    changes = pbp[score_cols].diff().to_numpy(dtype=np.float64, na_value=np.nan)
+    invalid = ~np.isin(changes, [0, 2, 3, 6, 7, 8]) & (scores != 0)
+    # a play with invalid changes for both teams is checked once per team
+    scores_index = np.sort(np.repeat(pbp.index.to_numpy(), invalid.sum(axis=1)))
+    scores_index = scores_index[
+        ~np.isin(scores_index - 1, ends_of_games)
+        & ~np.isin(scores_index, ends_of_games)
     ]
+    # each flagged play, the play before it, and the plays after it
+    offsets = np.arange(-1, num_plays - 1, dtype=np.int64)
+    neighborhood = (scores_index.astype(np.int64)[:, None] + offsets).ravel()
+    return pbp.loc[neighborhood]
+
+
+def groupwise_mode(arr):
+    """Return the mode of each row of a 2-D integer array, taking the smallest
+    value when there is a tie (the same as Series.mode()[0]).
+
+    Arguments:
+    arr -- a 2-D numpy array with one group per row
+    """
+    arr = np.sort(arr, axis=1)
+    counts = (arr[:, :, None] == arr[:, None, :]).sum(axis=2)
+    return arr[np.arange(len(arr)), counts.argmax(axis=1)]
 
 
 def fix_scores(pbp, num_plays=5):
@@ -174,39 +202,23 @@ def fix_scores(pbp, num_plays=5):
 
     Arguments:
     pbp -- the name of the play-by-play DataFrame
+    num_plays -- the number of plays around each invalid score to take the
+    mode of (see get_invalid_score_changes)
     """
-    scores_to_fix = get_invalid_score_changes(pbp)
-    home_modes = scores_to_fix.groupby(np.arange(len(scores_to_fix)) // num_plays)[
-        "home_score"
-    ].apply(lambda x: x.mode()[0])
-    away_modes = scores_to_fix.groupby(np.arange(len(scores_to_fix)) // num_plays)[
-        "away_score"
-    ].apply(lambda x: x.mode()[0])
-    for n in range(len(home_modes)):
-        pbp.loc[
-            scores_to_fix.iloc[
-                n * num_plays : (n * num_plays) + num_plays
-            ].index.tolist(),
-            "home_score",
-        ] = home_modes[n]
-        pbp.loc[
-            scores_to_fix.iloc[
-                n * num_plays : (n * num_plays) + num_plays
-            ].index.tolist(),
-            "away_score",
-        ] = away_modes[n]
+    scores_to_fix = get_invalid_score_changes(pbp, num_plays)
+    for col in "home_score", "away_score":
+        scores = scores_to_fix[col].to_numpy().reshape(-1, num_plays)
+        modes = groupwise_mode(scores)
+        pbp.loc[scores_to_fix.index, col] = np.repeat(modes, num_plays)
     return pbp
 
 
-def import_matchups(year, weeks):
-    matchup_df = pd.DataFrame()
-    for week in range(1, weeks + 1):
-        df = pd.DataFrame(
-            pd.read_csv(
-                f"../data/raw/matchups/{year} Week {week}.csv", encoding="ISO-8859-1"
-            )
-        )
-        matchup_df = matchup_df.append(df, ignore_index=True, sort=False)
+@cached_parquet("matchups", ("matchups",))
+def import_matchups(year, weeks, path="../data"):
+    tables = read_weeks(
+        "matchups", list(MATCHUP_TYPES), MATCHUP_TYPES, year, weeks, path, "ISO-8859-1"
+    )
+    matchup_df = tables_to_frame(tables)
     matchup_df["start_date"] = pd.to_datetime(matchup_df["start_date"])
     return matchup_df
 
@@ -218,40 +230,23 @@ def compare_pbp_matchup(pbp, matchup):
     pbp -- name of the play-by-play DataFrame
     matchup -- name of the matchup DataFrame
     """
-    periods = [
-        pbp.loc[(pbp["id"] == game) & (pbp["period"] == period)].index[-1]
-        for game in pbp["id"].unique()
-        for period in pbp.loc[pbp["id"] == game, "period"].unique()
+    score_cols = [
+        f"{side}_score_q{i}" for side in ("home", "away") for i in range(1, 6)
     ]
-    pbp_scores = (
-        pbp[
-            [
-                "id",
-                "week",
-                "home_team",
-                "away_team",
-                "period",
-                "home_score",
-                "away_score",
-            ]
-        ]
-        .loc[periods]
-        .copy()
-        .pivot_table(index=["id", "week", "home_team", "away_team"], columns="period")
-    )
-    pbp_scores.columns = [
-        f"{pbp_scores.columns.values[i][0]}_q{str(pbp_scores.columns.values[i][1])}"
-        for i in range(len(pbp_scores.columns.values))
+    periods = pbp.groupby(["id", "period"], sort=False, observed=True).tail(1).index
+    last_plays = pbp.loc[
+        periods,
+        ["id", "week", "home_team", "away_team", "period", "home_score", "away_score"],
     ]
+    # there is exactly one last play per game and period, so no aggregation
+    pbp_scores = last_plays.pivot(
+        index="id", columns="period", values=["home_score", "away_score"]
+    )
+    pbp_scores.columns = [f"{score}_q{period}" for score, period in pbp_scores.columns]
     pbp_scores = (
-        pbp_scores[
-            [
-                *[f"home_score_q{i}" for i in range(1, 6)],
-                *[f"away_score_q{i}" for i in range(1, 6)],
-            ]
-        ]
-        .reset_index()
-        .set_index("id", drop=True)
+        last_plays.drop_duplicates("id")
+        .set_index("id")[["week", "home_team", "away_team"]]
+        .join(pbp_scores.reindex(columns=score_cols))
         .sort_index()
     )
     matchup_scores = (
@@ -272,19 +267,19 @@ def compare_pbp_matchup(pbp, matchup):
         "week",
         "home_team",
         "away_team",
-        *[f"home_score_q{i}" for i in range(1, 6)],
-        *[f"away_score_q{i}" for i in range(1, 6)],
+        *score_cols,
     ]
+    matchup_scores = matchup_scores.reindex(pbp_scores.index)
     score_diffs = pbp_scores[["week", "home_team", "away_team"]].copy()
     for side in "home", "away":
-        cum_matchup_scores = matchup_scores[
-            [f"{side}_score_q{i}" for i in range(1, 6)]
-        ].cumsum(axis=1)
-        for quarter in range(1, 6):
-            score_diffs[f"{side}_score_q{quarter}"] = (
-                pbp_scores[f"{side}_score_q{quarter}"]
-                - cum_matchup_scores[f"{side}_score_q{quarter}"]
-            )
+        cols = [f"{side}_score_q{i}" for i in range(1, 6)]
+        side_scores = pbp_scores[cols].to_numpy(dtype=np.float64, na_value=np.nan)
+        matchup_side = matchup_scores[cols].to_numpy(dtype=np.float64, na_value=np.nan)
+        # a running total that skips missing periods, like DataFrame.cumsum
+        cum_matchup_scores = np.where(
+            np.isnan(matchup_side), np.nan, np.nancumsum(matchup_side, axis=1)
+        )
+        score_diffs[cols] = side_scores - cum_matchup_scores
     return score_diffs
 
 
@@ -297,16 +292,9 @@ def nonzero_score_diffs(pbp, matchup):
     matchup -- name of the matchup DataFrame
     """
     diffs = compare_pbp_matchup(pbp, matchup)
-    non_zero = diffs.loc[
-        (diffs["home_score_q1"] != 0)
-        | (diffs["home_score_q2"] != 0)
-        | (diffs["home_score_q3"] != 0)
-        | (diffs["home_score_q4"] != 0)
-        | (diffs.fillna(0)["home_score_q5"] != 0)
-        | (diffs["away_score_q1"] != 0)
-        | (diffs["away_score_q2"] != 0)
-        | (diffs["away_score_q3"] != 0)
-        | (diffs["away_score_q4"] != 0)
-        | (diffs.fillna(0)["away_score_q5"] != 0)
-    ]
+    cols = [f"{side}_score_q{i}" for side in ("home", "away") for i in range(1, 6)]
+    scores = diffs[cols].to_numpy(dtype=np.float64)
+    # a missing fifth period just means the game had no overtime
+    no_overtime = np.isnan(scores) & np.array([col.endswith("q5") for col in cols])
+    non_zero = diffs.loc[((scores != 0) & ~no_overtime).any(axis=1)]
     return non_zero